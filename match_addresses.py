@@ -11,9 +11,14 @@ import sys
 import re
 import json
 import ast
+import time
+import hashlib
 from typing import Optional, List, Dict, Tuple, Any
 from collections import defaultdict
+from dataclasses import dataclass
+import numpy as np
 import pandas as pd
+import openpyxl
 
 # Try to use rapidfuzz for faster matching, fall back to difflib
 fuzz: Any = None
@@ -28,6 +33,19 @@ except ImportError:
     from difflib import SequenceMatcher
     USE_RAPIDFUZZ = False
 
+# Use orjson for faster JSON parsing when available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# Use xlsxwriter's constant-memory mode for new workbooks when available
+try:
+    import xlsxwriter
+    XLSXWRITER_AVAILABLE = True
+except ImportError:
+    XLSXWRITER_AVAILABLE = False
+
 # BigQuery imports
 try:
     from google.cloud import bigquery
@@ -42,6 +60,9 @@ except ImportError:
 BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID', 'gen-lang-client-0844868008')
 BQ_LOCATION = os.getenv('BQ_LOCATION', 'US')
 
+# Local parquet cache for BigQuery reads (set to empty string to disable)
+BQ_CACHE_DIR = os.getenv('BQ_CACHE_DIR', '.bq_cache')
+
 # Table references
 HUBSPOT_TABLE = f'{BQ_PROJECT_ID}.HubSpot_Airbyte.companies'
 CLICKUP_TABLE = f'{BQ_PROJECT_ID}.ClickUp_AirbyteCustom.task'
@@ -49,6 +70,69 @@ CLICKUP_TABLE = f'{BQ_PROJECT_ID}.ClickUp_AirbyteCustom.task'
 # ClickUp Corporations List ID
 CORPORATIONS_LIST_ID = '901302721443'
 
+# HubSpot address properties, in the order they are joined into a full address
+HUBSPOT_ADDRESS_COLUMNS = ['properties_address', 'properties_address2', 'properties_city',
+                           'properties_state', 'properties_zip', 'properties_country']
+
+# Full HubSpot address built in SQL, skipping empty parts
+HUBSPOT_FULL_ADDRESS_SQL = (
+    "ARRAY_TO_STRING(["
+    + ", ".join(f"NULLIF(TRIM(CAST({column} AS STRING)), '')" for column in HUBSPOT_ADDRESS_COLUMNS)
+    + "], ', ') AS full_address"
+)
+
+# Address from the first ClickUp "Location" custom field that has one
+_CLICKUP_LOCATION_VALUE_SQL = (
+    "COALESCE(NULLIF(JSON_VALUE(cf, '$.value.formatted_address'), ''), "
+    "NULLIF(JSON_VALUE(cf, '$.value.address'), ''), "
+    "NULLIF(JSON_VALUE(cf, '$.value'), ''))"
+)
+CLICKUP_LOCATION_SQL = (
+    f"(SELECT {_CLICKUP_LOCATION_VALUE_SQL} "
+    "FROM UNNEST(JSON_QUERY_ARRAY(custom_fields)) AS cf WITH OFFSET AS pos "
+    f"WHERE LOWER(JSON_VALUE(cf, '$.name')) = 'location' AND {_CLICKUP_LOCATION_VALUE_SQL} IS NOT NULL "
+    "ORDER BY pos LIMIT 1) AS location"
+)
+
+# Columns read from each table (only what the matching uses)
+HUBSPOT_COLUMNS = ['COALESCE(CAST(id AS STRING), CAST(properties_hs_object_id AS STRING)) AS record_id',
+                   'properties_name', 'properties_parentconame', HUBSPOT_FULL_ADDRESS_SQL]
+CLICKUP_COLUMNS = ['id', 'name', 'url', 'locations', CLICKUP_LOCATION_SQL,
+                   "JSON_EXTRACT_SCALAR(list, '$.id') AS list_id"]
+
+# Threads used by rapidfuzz cdist scoring (-1 = all cores)
+MATCH_WORKERS = int(os.getenv('MATCH_WORKERS', '-1'))
+
+# Combined score weights for address and facility name similarity
+ADDRESS_WEIGHT = 0.6
+FACILITY_WEIGHT = 0.4
+
+# Minimum score to accept a same-ZIP match without rescoring the whole state
+# (HubSpot/ClickUp ZIPs are often missing or wrong, so weak ZIP matches escalate)
+ZIP_MATCH_THRESHOLD = 0.8
+
+# Candidates without a recognizable state in their address
+NO_STATE = '__NO_STATE__'
+
+# State code patterns, tried in order of preference
+_STATE_PATTERNS = [
+    re.compile(r',\s*([A-Za-z]{2})\s+\d{5}'),
+    re.compile(r',\s*([A-Za-z]{2})\s*,'),
+    re.compile(r'\b([A-Za-z]{2})\s+\d{5}'),
+]
+# Last 5-digit ZIP code (optionally ZIP+4) in an address
+_ZIP_RE = re.compile(r'.*\b(\d{5})(?:-\d{4})?\b')
+_US_STATES = frozenset({
+    'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA',
+    'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD',
+    'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ',
+    'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC',
+    'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY',
+    'DC', 'PR', 'VI', 'GU', 'AS', 'MP',
+})
+# Extracted state columns are dictionary-encoded: one shared string per state
+STATE_DTYPE = pd.CategoricalDtype(sorted(_US_STATES))
+
 # Global BigQuery client
 BQ_CLIENT = None
 
@@ -100,120 +184,119 @@ def init_bigquery_client() -> bigquery.Client:
         sys.exit(1)
 
 
-def read_from_bigquery(table_ref: str, query_filter: str = "") -> pd.DataFrame:
-    """Read data from BigQuery table with optional filter."""
+def bigquery_cache_path(table_ref: str, query_filter: str = "",
+                        columns: Optional[List[str]] = None) -> str:
+    """Local parquet cache file for a table read with an optional filter and projection."""
+    key_source = f"{table_ref}|{query_filter}|{','.join(columns or ['*'])}"
+    key = hashlib.sha1(key_source.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(BQ_CACHE_DIR, f"{table_ref.split('.')[-1]}_{key}.parquet")
+
+
+def read_from_bigquery(table_ref: str, query_filter: str = "",
+                       columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read data from BigQuery table with optional filter and column projection.
+
+    Results are cached to parquet under BQ_CACHE_DIR and reused until the
+    table is modified.
+    """
     if not BQ_CLIENT:
         init_bigquery_client()
 
+    cache_path = bigquery_cache_path(table_ref, query_filter, columns) if BQ_CACHE_DIR else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            table_modified = BQ_CLIENT.get_table(table_ref).modified
+            if table_modified and os.path.getmtime(cache_path) >= table_modified.timestamp():
+                df = pd.read_parquet(cache_path)
+                print(f"  ✓ Loaded {len(df)} rows from cache: {cache_path}")
+                return df
+        except Exception as e:
+            print(f"  Warning: Ignoring BigQuery cache {cache_path}: {e}")
+
     try:
-        query = f"SELECT * FROM `{table_ref}`"
+        query = f"SELECT {', '.join(columns or ['*'])} FROM `{table_ref}`"
         if query_filter:
             query += f" WHERE {query_filter}"
         
         print(f"  ⏳ Querying: {table_ref}")
         if query_filter:
             print(f"     Filter: {query_filter}")
+        queried_at = time.time()
         query_job = BQ_CLIENT.query(query)
-        df = query_job.to_dataframe()
+        df = query_job.to_dataframe(create_bqstorage_client=True)
         bytes_processed = query_job.total_bytes_processed or 0
         print(f"  ✓ Query completed: {bytes_processed:,} bytes processed")
         print(f"  ✓ Successfully loaded {len(df)} rows, {len(df.columns)} columns")
-        return df
     except Exception as e:
         print(f"  ✗ ERROR: Failed to read from BigQuery: {e}", file=sys.stderr)
         sys.exit(1)
 
+    if cache_path:
+        try:
+            os.makedirs(BQ_CACHE_DIR, exist_ok=True)
+            df.to_parquet(cache_path, index=False)
+            # Stamp with the query time so later table changes invalidate it
+            os.utime(cache_path, (queried_at, queried_at))
+        except Exception as e:
+            print(f"  Warning: Could not cache BigQuery results: {e}")
+    return df
 
-def extract_state_from_address(addr: str) -> Optional[str]:
-    """Extract 2-letter state code from US address."""
-    if not addr:
-        return None
-    patterns = [
-        r',\s*([A-Za-z]{2})\s+\d{5}',
-        r',\s*([A-Za-z]{2})\s*,',
-        r'\b([A-Za-z]{2})\s+\d{5}',
-    ]
-    us_states = {'AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DE', 'FL', 'GA',
-                'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD',
-                'MA', 'MI', 'MN', 'MS', 'MO', 'MT', 'NE', 'NV', 'NH', 'NJ',
-                'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC',
-                'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY',
-                'DC', 'PR', 'VI', 'GU', 'AS', 'MP'}
-    for pattern in patterns:
-        match = re.search(pattern, addr)
-        if match:
-            state = match.group(1).upper()
-            if state in us_states:
-                return state
-    return None
-
-
-def normalize_address(addr: str) -> str:
-    """Normalize address for comparison."""
-    if pd.isna(addr):
-        return ""
-    addr = str(addr).lower().strip()
-    addr = re.sub(r'\s+', ' ', addr)
-    addr = re.sub(r',?\s*united states of america$', '', addr)
-    addr = re.sub(r',?\s*usa$', '', addr)
-    return addr.strip()
-
-
-def build_hubspot_address(row: pd.Series) -> str:
-    """Build full address from HubSpot company properties."""
-    parts = []
-    if pd.notna(row.get('properties_address')) and str(row.get('properties_address')):
-        parts.append(str(row.get('properties_address')).strip())
-    if pd.notna(row.get('properties_address2')) and str(row.get('properties_address2')):
-        parts.append(str(row.get('properties_address2')).strip())
-    
-    city_state_zip = []
-    if pd.notna(row.get('properties_city')) and str(row.get('properties_city')):
-        city_state_zip.append(str(row.get('properties_city')).strip())
-    if pd.notna(row.get('properties_state')) and str(row.get('properties_state')):
-        city_state_zip.append(str(row.get('properties_state')).strip())
-    if pd.notna(row.get('properties_zip')) and str(row.get('properties_zip')):
-        city_state_zip.append(str(row.get('properties_zip')).strip())
-    
-    if city_state_zip:
-        parts.append(', '.join(city_state_zip))
-    
-    if pd.notna(row.get('properties_country')) and str(row.get('properties_country')):
-        parts.append(str(row.get('properties_country')).strip())
-    
-    return ', '.join(parts)
 
+def extract_states(addrs: pd.Series) -> pd.Series:
+    """Extract 2-letter state codes from a column of US addresses (categorical, NaN if not found)."""
+    states = pd.Series(None, index=addrs.index, dtype=object)
+    for pattern in _STATE_PATTERNS:
+        found = addrs.str.extract(pattern, expand=False).str.upper()
+        states = states.where(states.notna(), found.where(found.isin(_US_STATES)))
+    return states.astype(STATE_DTYPE)
 
-def extract_clickup_location(row: pd.Series) -> str:
-    """Extract location/address from ClickUp task custom fields."""
-    # Try custom_fields first - address is stored in "Location" field
-    if pd.notna(row.get('custom_fields')) and str(row.get('custom_fields')):
-        cf_str = str(row.get('custom_fields')).strip()
-        try:
-            cf_data = json.loads(cf_str)
-            if isinstance(cf_data, list):
-                for field in cf_data:
-                    if isinstance(field, dict):
-                        field_name = field.get('name', '').lower()
-                        # Look for Location field with address data
-                        if field_name == 'location':
-                            value = field.get('value')
-                            if isinstance(value, dict):
-                                if value.get('formatted_address'):
-                                    return str(value.get('formatted_address'))
-                                if value.get('address'):
-                                    return str(value.get('address'))
-                            elif isinstance(value, str) and value:
-                                return value
-        except (json.JSONDecodeError, TypeError):
-            pass
-    
-    # Fallback to locations field (rarely has data)
+
+def extract_zips(addrs: pd.Series) -> pd.Series:
+    """Extract 5-digit ZIP codes from a column of US addresses (None if not found)."""
+    zips = addrs.str.extract(_ZIP_RE, expand=False)
+    return zips.astype(object).where(zips.notna(), None)
+
+
+def normalize_series(addrs: pd.Series) -> pd.Series:
+    """Normalize a column of addresses (or names) for comparison."""
+    return (addrs.fillna('').astype(str).str.lower().str.strip()
+            .str.replace(r'\s+', ' ', regex=True)
+            .str.replace(r',?\s*united states of america$', '', regex=True)
+            .str.replace(r',?\s*usa$', '', regex=True)
+            .str.strip())
+
+
+def prepare_for_matching(values: pd.Series) -> np.ndarray:
+    """Strings in the form the active scorer compares (normalized for difflib).
+
+    Every string is prepared once here; scorers run with no per-pair
+    processor.
+    """
+    if not USE_RAPIDFUZZ:
+        values = normalize_series(values)
+    return values.fillna('').to_numpy(dtype=object)
+
+
+def text_column(df: pd.DataFrame, column: str) -> pd.Series:
+    """Column as strings, with missing values (or a missing column) as ''."""
+    if column not in df:
+        return pd.Series('', index=df.index, dtype=object)
+    values = df[column]
+    return values.astype(str).where(values.notna(), '')
+
+
+def extract_clickup_location(row: Dict[str, Any]) -> str:
+    """Extract location/address from a ClickUp task's locations field.
+
+    Fallback for tasks with no Location custom field; that field is
+    extracted in SQL (see CLICKUP_LOCATION_SQL).
+    """
+    # locations field (rarely has data)
     if pd.notna(row.get('locations')) and str(row.get('locations')):
         loc_str = str(row.get('locations')).strip()
         try:
-            loc_data = json.loads(loc_str)
-        except (json.JSONDecodeError, TypeError):
+            loc_data = json_loads(loc_str)
+        except (ValueError, TypeError):
             try:
                 loc_data = ast.literal_eval(loc_str)
             except (ValueError, SyntaxError):
@@ -236,48 +319,242 @@ def extract_clickup_location(row: pd.Series) -> str:
     return ""
 
 
-def combined_similarity_score(target_addr: str, target_facility: str, 
-                              candidate_addr: str, candidate_name: str) -> float:
-    """Calculate combined similarity using BOTH address and facility name."""
-    if not target_addr or not candidate_addr:
-        return 0.0
-    
-    # Address similarity (weight: 60%)
+def write_new_workbook(excel_file: str, sheets: Dict[str, pd.DataFrame]) -> None:
+    """Write each frame in ``sheets`` (sheet name -> frame) to a new workbook.
+
+    With xlsxwriter, rows are streamed in constant-memory mode. pandas writes
+    cells column by column, which constant-memory mode cannot take, so rows
+    are written directly.
+    """
+    if not XLSXWRITER_AVAILABLE:
+        with pd.ExcelWriter(excel_file) as writer:
+            for sheet_name, df in sheets.items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+        return
+
+    workbook = xlsxwriter.Workbook(excel_file, {'constant_memory': True, 'strings_to_urls': False})
+    try:
+        for sheet_name, df in sheets.items():
+            worksheet = workbook.add_worksheet(sheet_name)
+            worksheet.write_row(0, 0, [str(column) for column in df.columns])
+            values = df.astype(object).where(df.notna(), None).to_numpy()
+            for row_num, row in enumerate(values, start=1):
+                worksheet.write_row(row_num, 0, row)
+    finally:
+        workbook.close()
+
+
+def load_address_to_facility(excel_file: str, sheet_name: str) -> Dict[str, str]:
+    """Map each address to its first facility, streaming the sheet in read-only mode."""
+    wb = openpyxl.load_workbook(excel_file, read_only=True, data_only=True)
+    try:
+        rows = wb[sheet_name].iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        addr_col, facility_col = header.index('address'), header.index('facility')
+
+        address_to_facility = {}
+        for row in rows:
+            addr = row[addr_col] if addr_col < len(row) else None
+            facility = row[facility_col] if facility_col < len(row) else None
+            addr = str(addr).strip() if addr is not None else ''
+            facility = str(facility).strip() if facility is not None else ''
+            if addr and facility and addr not in address_to_facility:
+                address_to_facility[addr] = facility
+        return address_to_facility
+    finally:
+        wb.close()
+
+
+def similarity_matrix(queries: List[str], choices: List[str],
+                      score_cutoff: float = 0.0) -> np.ndarray:
+    """Score every query against every choice (0.0-1.0), one row per query.
+
+    Scores below ``score_cutoff`` are returned as 0, which lets the scorer
+    abandon those pairs early.
+    """
     if USE_RAPIDFUZZ:
-        addr_score = fuzz.token_set_ratio(target_addr, candidate_addr) / 100.0
-    else:
-        addr_score = SequenceMatcher(None, normalize_address(target_addr), 
-                                      normalize_address(candidate_addr)).ratio()
-    
-    # Facility name similarity (weight: 40%)
-    facility_score = 0.0
-    if target_facility and candidate_name:
-        if USE_RAPIDFUZZ:
-            facility_score = fuzz.token_set_ratio(target_facility, candidate_name) / 100.0
-        else:
-            facility_score = SequenceMatcher(None, normalize_address(target_facility), 
-                                              normalize_address(candidate_name)).ratio()
-    
-    # Combined weighted score
-    if facility_score > 0:
-        return (addr_score * 0.6) + (facility_score * 0.4)
-    else:
-        return addr_score
-
-
-def find_best_match_combined(target_addr: str, target_facility: str,
-                             candidates: List[Tuple[str, str, Dict]]) -> Tuple[Optional[Dict], float]:
-    """Find best match using combined address + facility name scoring."""
-    best_match = None
-    best_score = 0.0
-    
-    for addr_str, name_str, data in candidates:
-        score = combined_similarity_score(target_addr, target_facility, addr_str, name_str)
-        if score > best_score:
-            best_score = score
-            best_match = data
-    
-    return best_match, best_score
+        scores = process.cdist(queries, choices, scorer=fuzz.token_set_ratio, processor=None,
+                               score_cutoff=score_cutoff * 100, dtype=np.float64, workers=MATCH_WORKERS)
+        return scores / 100.0
+
+    # difflib path: strings are pre-normalized by prepare_for_matching
+    scores = np.zeros((len(queries), len(choices)))
+    for i, query in enumerate(queries):
+        if not query:
+            continue
+        matcher = SequenceMatcher(None, query)
+        for j, choice in enumerate(choices):
+            if not choice:
+                continue
+            matcher.set_seq2(choice)
+            if score_cutoff and (matcher.real_quick_ratio() < score_cutoff
+                                 or matcher.quick_ratio() < score_cutoff):
+                continue
+            score = matcher.ratio()
+            if score >= score_cutoff:
+                scores[i, j] = score
+    return scores
+
+
+def combined_similarity_matrix(target_addrs: List[str], target_facilities: List[str],
+                               candidate_addrs: List[str], candidate_names: List[str],
+                               match_threshold: float = 0.0) -> np.ndarray:
+    """Calculate combined similarity using BOTH address and facility name for every pair.
+
+    Address scores too low to reach ``match_threshold`` even with a perfect
+    facility name are cut off early; such pairs can only score below threshold.
+    """
+    addr_cutoff = max(0.0, (match_threshold - FACILITY_WEIGHT) / ADDRESS_WEIGHT)
+    addr_scores = similarity_matrix(target_addrs, candidate_addrs, score_cutoff=addr_cutoff)
+    facility_scores = similarity_matrix(target_facilities, candidate_names)
+
+    # Pairs without a facility name score on address alone
+    combined = np.where(facility_scores > 0,
+                        (addr_scores * ADDRESS_WEIGHT) + (facility_scores * FACILITY_WEIGHT),
+                        addr_scores)
+    combined[np.array([not addr for addr in target_addrs], dtype=bool)] = 0.0
+    return combined
+
+
+@dataclass
+class CandidateIndex:
+    """Column-oriented match candidates with row positions bucketed by state and ZIP."""
+    addrs: np.ndarray                          # address of each candidate, as compared
+    names: np.ndarray                          # name of each candidate, as compared
+    data: pd.DataFrame                         # result fields, one row per candidate
+    by_state: Dict[str, np.ndarray]            # state -> candidate positions
+    by_zip: Dict[Tuple[str, str], np.ndarray]  # (state, zip5) -> candidate positions
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def build_candidate_index(addrs: pd.Series, names: pd.Series, data: pd.DataFrame,
+                          states: Optional[pd.Series] = None) -> CandidateIndex:
+    """Index candidates for matching, bucketed by state and ZIP when states are given."""
+    by_state, by_zip = {}, {}
+    if states is not None:
+        zips = extract_zips(addrs).to_numpy()
+        has_zip = np.flatnonzero(states.notna().to_numpy() & pd.notna(zips))
+        zip_groups = pd.Series(has_zip).groupby([states.to_numpy()[has_zip], zips[has_zip]]).indices
+        by_zip = {key: has_zip[block] for key, block in zip_groups.items()}
+        states = states.cat.add_categories(NO_STATE).fillna(NO_STATE)
+        by_state = states.groupby(states, observed=True).indices
+    return CandidateIndex(
+        addrs=prepare_for_matching(addrs),
+        names=prepare_for_matching(names),
+        data=data.reset_index(drop=True),
+        by_state=by_state,
+        by_zip=by_zip,
+    )
+
+
+def find_best_matches(scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Best candidate position (-1 if nothing scores above 0) and score for each row."""
+    if not scores.shape[1]:
+        return np.full(len(scores), -1), np.zeros(len(scores))
+    best_idx = scores.argmax(axis=1)
+    best_scores = scores[np.arange(len(scores)), best_idx]
+    return np.where(best_scores > 0, best_idx, -1), np.where(best_scores > 0, best_scores, 0.0)
+
+
+def find_best_matches_combined(target_addrs: List[str], target_facilities: List[str],
+                               candidate_addrs: np.ndarray, candidate_names: np.ndarray,
+                               match_threshold: float = 0.0) -> Tuple[np.ndarray, np.ndarray]:
+    """Find best match for each target using combined address + facility name scoring."""
+    if not len(candidate_addrs):
+        return np.full(len(target_addrs), -1), np.zeros(len(target_addrs))
+    scores = combined_similarity_matrix(target_addrs, target_facilities,
+                                        candidate_addrs, candidate_names, match_threshold)
+    return find_best_matches(scores)
+
+
+def _match_blocks(addrs: np.ndarray, facilities: np.ndarray, rows: np.ndarray,
+                  row_blocks: List[Any], blocks: Dict[Any, np.ndarray], index: CandidateIndex,
+                  match_threshold: float, positions: np.ndarray, scores: np.ndarray) -> None:
+    """Score ``rows`` against the candidate block named by each row, updating positions/scores."""
+    rows_by_block = defaultdict(list)
+    for i in rows:
+        if row_blocks[i] in blocks:
+            rows_by_block[row_blocks[i]].append(i)
+
+    for block, block_rows in rows_by_block.items():
+        block_positions = blocks[block]
+        best, best_scores = find_best_matches_combined(
+            addrs[block_rows], facilities[block_rows],
+            index.addrs[block_positions], index.names[block_positions], match_threshold
+        )
+        positions[block_rows] = np.where(best >= 0, block_positions[best], -1)
+        scores[block_rows] = best_scores
+
+
+def match_by_state(target_addrs: List[str], target_facilities: List[str],
+                   target_states: pd.Series, target_zips: List[Optional[str]],
+                   index: CandidateIndex,
+                   match_threshold: float) -> Tuple[np.ndarray, np.ndarray, int, int, int]:
+    """Match targets against same-ZIP, then same-state, then all candidates.
+
+    Each distinct (address, facility, state, ZIP) target is scored once, and
+    each wider pass only rescores targets still below threshold. Same-ZIP
+    matches must also reach ZIP_MATCH_THRESHOLD to skip the state pass.
+
+    Returns (positions, scores, zip_matches, state_matches, fallback_matches);
+    positions index into ``index`` and are -1 where nothing matched.
+    """
+    keys = pd.DataFrame({
+        'addr': target_addrs,
+        'facility': target_facilities,
+        'state': target_states.cat.add_categories('').fillna('').to_numpy(),
+        'zip': [zip_code or '' for zip_code in target_zips],
+    })
+    inverse = keys.groupby(list(keys.columns), sort=False, observed=True).ngroup().to_numpy()
+    unique_keys = keys.drop_duplicates()
+    addrs, facilities = unique_keys['addr'].to_numpy(), unique_keys['facility'].to_numpy()
+    states = unique_keys['state'].tolist()
+    zip_blocks = list(zip(states, unique_keys['zip']))
+
+    positions = np.full(len(unique_keys), -1)
+    scores = np.zeros(len(unique_keys))
+
+    def matched(threshold: float = match_threshold) -> np.ndarray:
+        return (positions >= 0) & (scores >= threshold)
+
+    _match_blocks(addrs, facilities, np.arange(len(unique_keys)), zip_blocks, index.by_zip,
+                  index, match_threshold, positions, scores)
+    zip_matched = matched(max(match_threshold, ZIP_MATCH_THRESHOLD))
+
+    _match_blocks(addrs, facilities, np.flatnonzero(~zip_matched), states, index.by_state,
+                  index, match_threshold, positions, scores)
+    state_matched = matched()
+
+    fallback_rows = np.flatnonzero(~state_matched)
+    if len(fallback_rows):
+        positions[fallback_rows], scores[fallback_rows] = find_best_matches_combined(
+            addrs[fallback_rows], facilities[fallback_rows], index.addrs, index.names, match_threshold
+        )
+    all_matched = matched()
+
+    # Broadcast results back to every target row
+    zip_matched, state_matched, all_matched = zip_matched[inverse], state_matched[inverse], all_matched[inverse]
+    return (positions[inverse], scores[inverse], int(zip_matched.sum()),
+            int((state_matched & ~zip_matched).sum()), int((all_matched & ~state_matched).sum()))
+
+
+def take_matches(index: CandidateIndex, positions: np.ndarray, scores: np.ndarray,
+                 match_threshold: float) -> pd.DataFrame:
+    """Result fields of each matched candidate, '' where the score is below threshold."""
+    matched = (positions >= 0) & (scores >= match_threshold)
+    columns = {}
+    for column in index.data.columns:
+        values = np.full(len(positions), '', dtype=object)
+        values[matched] = index.data[column].to_numpy(dtype=object)[positions[matched]]
+        columns[column] = values
+    return pd.DataFrame(columns)
+
+
+def match_scores(positions: np.ndarray, scores: np.ndarray) -> List[float]:
+    """Rounded match scores for output (0 where nothing matched)."""
+    return [round(float(score), 3) if position >= 0 else 0 for position, score in zip(positions, scores)]
 
 
 def main():
@@ -295,29 +572,20 @@ def main():
     try:
         unique_df = pd.read_excel(excel_file, sheet_name='Unique Addresses')
         
-        # Read employees sheet to get facility mapping
-        employees_df = pd.read_excel(excel_file, sheet_name='employees')
-        
-        # Create address -> facility mapping
-        address_to_facility = {}
-        for _, row in employees_df.iterrows():
-            addr = str(row.get('address', '')).strip() if pd.notna(row.get('address')) else ''
-            facility = str(row.get('facility', '')).strip() if pd.notna(row.get('facility')) else ''
-            if addr and facility and addr not in address_to_facility:
-                address_to_facility[addr] = facility
+        # Stream employees sheet to get address -> facility mapping
+        address_to_facility = load_address_to_facility(excel_file, 'employees')
         
         print(f"  ✓ Built facility mapping for {len(address_to_facility)} addresses")
         
-        # Add facility column to unique addresses
-        unique_df['facility'] = unique_df['unique_address'].map(address_to_facility)
+        # Add facility column to unique addresses (written back with the results in step 6)
+        facilities = unique_df['unique_address'].map(address_to_facility)
+        facility_changed = ('facility' not in unique_df
+                            or unique_df['facility'].fillna('').astype(str).tolist()
+                            != facilities.fillna('').astype(str).tolist())
+        unique_df['facility'] = facilities
         unmatched = unique_df['facility'].isna().sum()
         print(f"  ✓ Matched {len(unique_df) - unmatched} addresses to facilities ({unmatched} unmatched)")
         
-        # Save back to Excel with facility column
-        with pd.ExcelWriter(excel_file, mode='a', engine='openpyxl', if_sheet_exists='replace') as writer:
-            unique_df.to_excel(writer, sheet_name='Unique Addresses', index=False)
-        print(f"  ✓ Updated 'Unique Addresses' sheet with facility column")
-        
         unique_addresses = unique_df['unique_address'].tolist()
         facility_names = unique_df['facility'].fillna('').tolist()
         
@@ -327,181 +595,116 @@ def main():
     
     # Step 2: Query HubSpot companies
     print("\n[2/6] Querying HubSpot companies...")
-    hs_df = read_from_bigquery(HUBSPOT_TABLE)
+    hs_df = read_from_bigquery(HUBSPOT_TABLE, columns=HUBSPOT_COLUMNS)
     
     print("  Building HubSpot address+name index by state...")
-    hubspot_by_state = defaultdict(list)
-    no_state_count = 0
-    
-    for _, row in hs_df.iterrows():
-        full_addr = build_hubspot_address(row)
-        company_name = str(row.get('properties_name', '')) if pd.notna(row.get('properties_name')) else ''
-        parent_company = str(row.get('properties_parentconame', '')) if pd.notna(row.get('properties_parentconame')) else ''
-        if full_addr:
-            state = extract_state_from_address(full_addr)
-            data = {
-                'hubspot_record_id': row.get('id') or row.get('properties_hs_object_id'),
-                'hubspot_company_name': company_name,
-                'hubspot_full_address': full_addr,
-                'hubspot_parent_company': parent_company,
-            }
-            if state:
-                hubspot_by_state[state].append((full_addr, company_name, data))
-            else:
-                no_state_count += 1
-                hubspot_by_state['__NO_STATE__'].append((full_addr, company_name, data))
-    
-    total_hs = sum(len(v) for v in hubspot_by_state.values())
-    print(f"  ✓ Indexed {total_hs} HubSpot records across {len(hubspot_by_state)-1} states")
-    
-    # Step 3: Query ClickUp Corporations list
-    print("\n[3/6] Querying ClickUp Corporations list...")
-    corporations_filter = f"JSON_EXTRACT_SCALAR(list, '$.id') = '{CORPORATIONS_LIST_ID}'"
-    corp_df = read_from_bigquery(CLICKUP_TABLE, corporations_filter)
+    hs_full_addrs = text_column(hs_df, 'full_address')
+    has_addr = hs_full_addrs != ''
+    hs_candidates = pd.DataFrame({
+        'hubspot_record_id': hs_df['record_id'],
+        'hubspot_company_name': text_column(hs_df, 'properties_name'),
+        'hubspot_full_address': hs_full_addrs,
+        'hubspot_parent_company': text_column(hs_df, 'properties_parentconame'),
+    })[has_addr]
+    hs_index = build_candidate_index(
+        hs_candidates['hubspot_full_address'], hs_candidates['hubspot_company_name'], hs_candidates,
+        extract_states(hs_candidates['hubspot_full_address'])
+    )
+    
+    print(f"  ✓ Indexed {len(hs_index)} HubSpot records across {len(hs_index.by_state) - (NO_STATE in hs_index.by_state)} states")
+    
+    # Step 3: Query all ClickUp tasks once; the Corporations list is a subset of them
+    print("\n[3/6] Querying ClickUp tasks...")
+    cu_df = read_from_bigquery(CLICKUP_TABLE, columns=CLICKUP_COLUMNS)
+    corp_df = cu_df[cu_df['list_id'] == CORPORATIONS_LIST_ID]
     
     print("  Building Corporations list index (by name - no addresses)...")
     # Corporations list tasks don't have Location fields, so we match by name only
-    corporations_candidates = []
-    
-    for _, row in corp_df.iterrows():
-        task_name = str(row.get('name', '')) if pd.notna(row.get('name')) else ''
-        if task_name:
-            data = {
-                'corporations_task_id': row.get('id'),
-                'corporations_task_name': task_name,
-                'corporations_task_location': '',
-                'corporations_task_url': row.get('url'),
-            }
-            # Use task name as both location (for matching) and name
-            corporations_candidates.append((task_name, task_name, data))
-    
-    print(f"  ✓ Indexed {len(corporations_candidates)} Corporations list tasks")
-    
-    # Step 4: Query all ClickUp tasks for facility matching
-    print("\n[4/6] Querying ClickUp tasks...")
-    cu_df = read_from_bigquery(CLICKUP_TABLE)
-    
-    print("  Building ClickUp location+name index by state...")
-    clickup_by_state = defaultdict(list)
-    no_state_count_cu = 0
-    
-    for _, row in cu_df.iterrows():
-        location = extract_clickup_location(row)
-        task_name = str(row.get('name', '')) if pd.notna(row.get('name')) else ''
-        if location:
-            state = extract_state_from_address(location)
-            data = {
-                'clickup_task_id': row.get('id'),
-                'clickup_task_name': task_name,
-                'clickup_task_location': location,
-                'clickup_url': row.get('url'),
-            }
-            if state:
-                clickup_by_state[state].append((location, task_name, data))
-            else:
-                no_state_count_cu += 1
-                clickup_by_state['__NO_STATE__'].append((location, task_name, data))
-    
-    total_cu = sum(len(v) for v in clickup_by_state.values())
-    print(f"  ✓ Indexed {total_cu} ClickUp records across {len(clickup_by_state)-1} states")
+    corp_task_names = text_column(corp_df, 'name')
+    corp_candidates = pd.DataFrame({
+        'corporations_task_id': corp_df.get('id'),
+        'corporations_task_name': corp_task_names,
+        'corporations_task_location': '',
+        'corporations_task_url': corp_df.get('url'),
+    })[corp_task_names != '']
+    corp_index = build_candidate_index(
+        corp_candidates['corporations_task_name'], corp_candidates['corporations_task_name'], corp_candidates
+    )
+    
+    print(f"  ✓ Indexed {len(corp_index)} Corporations list tasks")
+    
+    # Step 4: Index all ClickUp tasks for facility matching
+    print("\n[4/6] Building ClickUp location+name index by state...")
+    cu_locations = text_column(cu_df, 'location')
+    no_location = cu_locations == ''
+    if no_location.any():
+        cu_locations[no_location] = [
+            extract_clickup_location(row) for row in cu_df.loc[no_location, ['locations']].to_dict('records')
+        ]
+    cu_candidates = pd.DataFrame({
+        'clickup_task_id': cu_df.get('id'),
+        'clickup_task_name': text_column(cu_df, 'name'),
+        'clickup_task_location': cu_locations,
+        'clickup_task_url': cu_df.get('url'),
+    })[cu_locations != '']
+    cu_index = build_candidate_index(
+        cu_candidates['clickup_task_location'], cu_candidates['clickup_task_name'], cu_candidates,
+        extract_states(cu_candidates['clickup_task_location'])
+    )
+    
+    print(f"  ✓ Indexed {len(cu_index)} ClickUp records across {len(cu_index.by_state) - (NO_STATE in cu_index.by_state)} states")
     
     # Step 5: Match addresses with combined scoring
     print("\n[5/6] Matching with address + facility name...")
-    results = []
     match_threshold = 0.5
-    stats = {'hs_state_match': 0, 'hs_fallback': 0, 'cu_state_match': 0, 'cu_fallback': 0, 
+    stats = {'hs_zip_match': 0, 'hs_state_match': 0, 'hs_fallback': 0,
+             'cu_zip_match': 0, 'cu_state_match': 0, 'cu_fallback': 0,
              'corp_state_match': 0, 'corp_fallback': 0}
     
-    for i, (unique_addr, facility_name) in enumerate(zip(unique_addresses, facility_names), 1):
-        if i % 50 == 0 or i == 1:
-            print(f"  [{i}/{len(unique_addresses)}] Processing...")
-        
-        target_state = extract_state_from_address(unique_addr)
-        
-        # Find HubSpot match using combined scoring
-        hs_match = None
-        hs_score = 0.0
-        if target_state and target_state in hubspot_by_state:
-            hs_match, hs_score = find_best_match_combined(
-                unique_addr, facility_name, hubspot_by_state[target_state]
-            )
-            if hs_match and hs_score >= match_threshold:
-                stats['hs_state_match'] += 1
-        
-        if not hs_match or hs_score < match_threshold:
-            all_hs = []
-            for state, candidates in hubspot_by_state.items():
-                all_hs.extend(candidates)
-            hs_match, hs_score = find_best_match_combined(unique_addr, facility_name, all_hs)
-            if hs_match and hs_score >= match_threshold:
-                stats['hs_fallback'] += 1
-        
-        # Find ClickUp match using combined scoring
-        cu_match = None
-        cu_score = 0.0
-        if target_state and target_state in clickup_by_state:
-            cu_match, cu_score = find_best_match_combined(
-                unique_addr, facility_name, clickup_by_state[target_state]
-            )
-            if cu_match and cu_score >= match_threshold:
-                stats['cu_state_match'] += 1
-        
-        if not cu_match or cu_score < match_threshold:
-            all_cu = []
-            for state, candidates in clickup_by_state.items():
-                all_cu.extend(candidates)
-            cu_match, cu_score = find_best_match_combined(unique_addr, facility_name, all_cu)
-            if cu_match and cu_score >= match_threshold:
-                stats['cu_fallback'] += 1
-        
-        # Find Corporations list match by name only (no addresses in Corporations list)
-        corp_match = None
-        corp_score = 0.0
-        if corporations_candidates:
-            # For Corporations, we only match by facility name since there's no address
-            best_corp_match = None
-            best_corp_score = 0.0
-            for addr_str, name_str, data in corporations_candidates:
-                if USE_RAPIDFUZZ:
-                    score = fuzz.token_set_ratio(facility_name, name_str) / 100.0
-                else:
-                    score = SequenceMatcher(None, normalize_address(facility_name), 
-                                              normalize_address(name_str)).ratio()
-                if score > best_corp_score:
-                    best_corp_score = score
-                    best_corp_match = data
-            
-            if best_corp_match and best_corp_score >= match_threshold:
-                corp_match = best_corp_match
-                corp_score = best_corp_score
-                stats['corp_fallback'] += 1
-        
-        result = {
-            'unique_address': unique_addr,
-            'facility_name': facility_name,
-            'target_state': target_state or '',
-            'hubspot_company_name': hs_match.get('hubspot_company_name') if hs_match and hs_score >= match_threshold else '',
-            'hubspot_record_id': hs_match.get('hubspot_record_id') if hs_match and hs_score >= match_threshold else '',
-            'hubspot_full_address': hs_match.get('hubspot_full_address') if hs_match and hs_score >= match_threshold else '',
-            'hubspot_parent_company': hs_match.get('hubspot_parent_company') if hs_match and hs_score >= match_threshold else '',
-            'hubspot_match_score': round(hs_score, 3) if hs_match else 0,
-            'clickup_task_name': cu_match.get('clickup_task_name') if cu_match and cu_score >= match_threshold else '',
-            'clickup_task_location': cu_match.get('clickup_task_location') if cu_match and cu_score >= match_threshold else '',
-            'clickup_match_score': round(cu_score, 3) if cu_match else 0,
-            'clickup_task_url': cu_match.get('clickup_url') if cu_match and cu_score >= match_threshold else '',
-            'corporations_task_name': corp_match.get('corporations_task_name') if corp_match and corp_score >= match_threshold else '',
-            'corporations_task_location': corp_match.get('corporations_task_location') if corp_match and corp_score >= match_threshold else '',
-            'corporations_task_url': corp_match.get('corporations_task_url') if corp_match and corp_score >= match_threshold else '',
-            'corporations_match_score': round(corp_score, 3) if corp_match else 0,
-        }
-        results.append(result)
-    
-    print(f"  ✓ Completed matching for {len(results)} addresses")
+    target_states = extract_states(unique_df['unique_address'])
+    target_zips = extract_zips(unique_df['unique_address']).tolist()
+    target_addrs = prepare_for_matching(unique_df['unique_address'])
+    target_facilities = prepare_for_matching(unique_df['facility'])
+
+    # Find HubSpot and ClickUp matches using combined scoring
+    print(f"  Scoring {len(unique_addresses)} addresses against HubSpot...")
+    hs_positions, hs_scores, stats['hs_zip_match'], stats['hs_state_match'], stats['hs_fallback'] = match_by_state(
+        target_addrs, target_facilities, target_states, target_zips, hs_index, match_threshold
+    )
+    print(f"  Scoring {len(unique_addresses)} addresses against ClickUp...")
+    cu_positions, cu_scores, stats['cu_zip_match'], stats['cu_state_match'], stats['cu_fallback'] = match_by_state(
+        target_addrs, target_facilities, target_states, target_zips, cu_index, match_threshold
+    )
+
+    # Find Corporations list match by name only (no addresses in Corporations list)
+    # Facility names repeat across addresses; score each distinct name once
+    name_codes, unique_names = pd.factorize(target_facilities)
+    corp_positions, corp_scores = find_best_matches(
+        similarity_matrix(list(unique_names), corp_index.names, score_cutoff=match_threshold)
+    )
+    # score_cutoff already zeroes pairs below the threshold, so any position found is a match
+    corp_positions, corp_scores = corp_positions[name_codes], corp_scores[name_codes]
+    stats['corp_fallback'] = int((corp_positions >= 0).sum())
+
+    # Emit all result columns at once from the matched candidate positions
+    results_df = pd.concat([
+        pd.DataFrame({
+            'unique_address': unique_addresses,
+            'facility_name': facility_names,
+            'target_state': target_states.cat.add_categories('').fillna('').to_numpy(dtype=object),
+            'hubspot_match_score': match_scores(hs_positions, hs_scores),
+            'clickup_match_score': match_scores(cu_positions, cu_scores),
+            'corporations_match_score': match_scores(corp_positions, corp_scores),
+        }),
+        take_matches(hs_index, hs_positions, hs_scores, match_threshold),
+        take_matches(cu_index, cu_positions, cu_scores, match_threshold),
+        take_matches(corp_index, corp_positions, corp_scores, match_threshold),
+    ], axis=1)
+    
+    print(f"  ✓ Completed matching for {len(results_df)} addresses")
     
     # Step 6: Save results
     print("\n[6/6] Saving results to Excel...")
-    results_df = pd.DataFrame(results)
-    
     column_order = [
         'unique_address',
         'facility_name',
@@ -523,26 +726,37 @@ def main():
     results_df = results_df[column_order]
     
     try:
+        # Rewrite the workbook once for both the facility column and the results
         with pd.ExcelWriter(excel_file, mode='a', engine='openpyxl', if_sheet_exists='replace') as writer:
+            if facility_changed:
+                unique_df.to_excel(writer, sheet_name='Unique Addresses', index=False)
             results_df.to_excel(writer, sheet_name=output_sheet, index=False)
+        if facility_changed:
+            print(f"  ✓ Updated 'Unique Addresses' sheet with facility column")
         print(f"  ✓ Results saved to '{output_sheet}' sheet in {excel_file}")
     except Exception as e:
         output_file = 'matched_facilities_results.xlsx'
-        results_df.to_excel(output_file, sheet_name=output_sheet, index=False)
+        # Keep the new facility column too; it was only going to be saved with the results
+        sheets = {output_sheet: results_df}
+        if facility_changed:
+            sheets['Unique Addresses'] = unique_df
+        write_new_workbook(output_file, sheets)
         print(f"  ✓ Results saved to new file: {output_file}")
+        if facility_changed:
+            print(f"  ✓ 'Unique Addresses' with facility column saved to {output_file}")
     
     # Print summary
     print("\n" + "=" * 60)
     print("Matching Summary (Address + Facility Name)")
     print("=" * 60)
-    hs_matches = sum(1 for r in results if r['hubspot_match_score'] >= match_threshold)
-    cu_matches = sum(1 for r in results if r['clickup_match_score'] >= match_threshold)
-    corp_matches = sum(1 for r in results if r['corporations_match_score'] >= match_threshold)
-    
-    print(f"Total unique addresses: {len(results)}")
-    print(f"Addresses with facility names: {sum(1 for r in results if r['facility_name'])}")
-    print(f"HubSpot matches: {hs_matches} (state-filtered: {stats['hs_state_match']}, fallback: {stats['hs_fallback']})")
-    print(f"ClickUp matches: {cu_matches} (state-filtered: {stats['cu_state_match']}, fallback: {stats['cu_fallback']})")
+    score_columns = ['hubspot_match_score', 'clickup_match_score', 'corporations_match_score']
+    hs_matches, cu_matches, corp_matches = (results_df[score_columns] >= match_threshold).sum().tolist()
+    facility_present = int(results_df['facility_name'].astype(bool).sum())
+    
+    print(f"Total unique addresses: {len(results_df)}")
+    print(f"Addresses with facility names: {facility_present}")
+    print(f"HubSpot matches: {hs_matches} (ZIP-filtered: {stats['hs_zip_match']}, state-filtered: {stats['hs_state_match']}, fallback: {stats['hs_fallback']})")
+    print(f"ClickUp matches: {cu_matches} (ZIP-filtered: {stats['cu_zip_match']}, state-filtered: {stats['cu_state_match']}, fallback: {stats['cu_fallback']})")
     print(f"Corporations list matches: {corp_matches} (state-filtered: {stats['corp_state_match']}, fallback: {stats['corp_fallback']})")
     print(f"Match threshold: {match_threshold}")
     print("=" * 60)
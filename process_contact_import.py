@@ -8,10 +8,20 @@ Process HubSpot Contact Import sheet:
 """
 
 import os
-import sys
 import re
+import sys
+import time
+import hashlib
+import openpyxl
 import pandas as pd
-from typing import Optional, Tuple
+from typing import List, Tuple, Union
+
+# Use the Rust calamine reader for Excel sheets when available (default: openpyxl)
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_READ_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_READ_ENGINE = None
 
 # BigQuery imports
 try:
@@ -20,6 +30,13 @@ try:
 except ImportError:
     BIGQUERY_AVAILABLE = False
 
+# BigQuery Storage API (faster Arrow downloads); falls back to REST pages
+try:
+    from google.cloud import bigquery_storage
+    BQSTORAGE_AVAILABLE = True
+except ImportError:
+    BQSTORAGE_AVAILABLE = False
+
 # =========================
 # BigQuery Configuration
 # =========================
@@ -27,6 +44,29 @@ BQ_PROJECT_ID = os.getenv('BQ_PROJECT_ID', 'gen-lang-client-0844868008')
 BQ_LOCATION = os.getenv('BQ_LOCATION', 'US')
 HUBSPOT_CONTACTS_TABLE = f'{BQ_PROJECT_ID}.HubSpot_Airbyte.contacts'
 
+# Local parquet cache for HubSpot contact indexes (set to empty string to disable)
+BQ_CACHE_DIR = os.getenv('BQ_CACHE_DIR', '.bq_cache')
+
+# HubSpot contact fields copied onto matched contacts
+HUBSPOT_CONTACT_FIELDS = ['contact_record_id', 'hs_first_name', 'hs_last_name', 'hs_company_name']
+
+# Matched Facilities columns used to associate contacts with companies
+FACILITY_COLUMNS = ['unique_address', 'hubspot_record_id', 'clickup_task_url', 'hubspot_company_name']
+
+# Key and HubSpot text columns are held as Arrow-backed strings, so the
+# .str normalization runs in Arrow compute kernels
+TEXT_DTYPE = 'string[pyarrow]'
+HUBSPOT_TEXT_COLUMNS = ['hs_first_name', 'hs_last_name', 'hs_company_name', 'email_key', 'first_key', 'last_key']
+
+# Rows per page when HubSpot contacts are downloaded over REST
+CONTACT_BATCH_SIZE = 8192
+
+# Minimum seconds between progress lines while downloading
+PROGRESS_INTERVAL = 1.0
+
+# Task ID path segment of a ClickUp task URL
+_CLICKUP_RE = re.compile(r'/t/([a-zA-Z0-9]+)')
+
 BQ_CLIENT = None
 
 
@@ -42,103 +82,162 @@ def init_bigquery_client() -> bigquery.Client:
     return BQ_CLIENT
 
 
-def extract_clickup_task_id(url: str) -> str:
-    """Extract task ID from ClickUp URL.
+def as_text(values: Union[pd.Series, pd.DataFrame]) -> Union[pd.Series, pd.DataFrame]:
+    """A column (or frame of columns) as Arrow-backed strings, with '' for missing values."""
+    return values.astype(TEXT_DTYPE).fillna('')
+
+
+def extract_clickup_task_ids(urls: pd.Series) -> pd.Series:
+    """Extract task IDs from a column of ClickUp URLs ('' if not found).
     Example: https://app.clickup.com/t/86a2vwzc1 -> 86a2vwzc1
     """
-    if pd.isna(url) or not url:
-        return ''
-    match = re.search(r'/t/([a-zA-Z0-9]+)', str(url))
-    return match.group(1) if match else ''
-
-
-def split_name(full_name: str) -> Tuple[str, str]:
-    """Split full name into first and last name."""
-    if pd.isna(full_name) or not full_name:
-        return '', ''
-    parts = str(full_name).strip().split()
-    if len(parts) == 1:
-        return parts[0], ''
-    elif len(parts) == 2:
-        return parts[0], parts[1]
-    else:
-        # Handle middle names - first name + rest as last name
-        return parts[0], ' '.join(parts[1:])
-
-
-def load_hubspot_contacts() -> Tuple[pd.DataFrame, dict, dict]:
-    """Load all HubSpot contacts into memory for fast lookup."""
-    if not BIGQUERY_AVAILABLE:
-        return pd.DataFrame(), {}, {}
+    return as_text(urls).str.extract(_CLICKUP_RE, expand=False).fillna('')
+
+
+def split_names(full_names: pd.Series) -> pd.DataFrame:
+    """Split a column of full names into 'first' and 'last' name columns.
+
+    Middle names go into the last name: first name + rest as last name.
+    """
+    words = as_text(full_names).str.split()
+    return pd.DataFrame({'first': words.str[0].fillna(''), 'last': words.str[1:].str.join(' ')},
+                        index=full_names.index)
+
+
+def keep_last(index: pd.DataFrame) -> pd.DataFrame:
+    """Drop all but the last row for each repeated index key."""
+    return index[~index.index.duplicated(keep='last')]
+
+
+def index_hubspot_contacts(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Index HubSpot contacts by email key and by (first, last) name key.
+
+    The keys are normalized in SQL (see load_hubspot_contacts). Later rows win
+    for repeated keys; contacts without a full name are not name-indexed.
+    """
+    emails = as_text(df['email_key']).rename('email')
+    firsts = as_text(df['first_key']).rename('first')
+    lasts = as_text(df['last_key']).rename('last')
+    contacts = df[HUBSPOT_CONTACT_FIELDS]
+    
+    has_email = emails != ''
+    has_name = (firsts != '') & (lasts != '')
+    return (keep_last(contacts[has_email].set_index(emails[has_email])),
+            keep_last(contacts[has_name].set_index([firsts[has_name], lasts[has_name]])))
+
+
+def hubspot_cache_paths(emails: List[str], name_keys: List[str]) -> Tuple[str, str]:
+    """Local parquet cache files for the email and name indexes of one set of lookup keys."""
+    key_source = f"{HUBSPOT_CONTACTS_TABLE}|{','.join(emails)}|{','.join(name_keys)}"
+    key = hashlib.sha1(key_source.encode('utf-8')).hexdigest()[:16]
+    prefix = os.path.join(BQ_CACHE_DIR, f"{HUBSPOT_CONTACTS_TABLE.split('.')[-1]}_{key}")
+    return f"{prefix}_email.parquet", f"{prefix}_name.parquet"
+
+
+def load_hubspot_contacts(emails: List[str], name_keys: List[str]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Stream the HubSpot contacts matching any of the given keys into email and name indexes.
+
+    ``emails`` are lowercased, stripped emails and ``name_keys`` are
+    "first|last" keys, normalized the same way. BigQuery filters on them so
+    only candidate contacts are downloaded. Each downloaded batch is indexed
+    as it arrives, so the result is never held as one DataFrame.
+
+    The indexes are cached to parquet under BQ_CACHE_DIR and reused for the
+    same keys until the contacts table is modified.
+    """
+    email_index, name_index = index_hubspot_contacts(
+        pd.DataFrame(columns=HUBSPOT_CONTACT_FIELDS + ['email_key', 'first_key', 'last_key'], dtype=object)
+    )
+    if not BIGQUERY_AVAILABLE or not (emails or name_keys):
+        return email_index, name_index
     
     client = init_bigquery_client()
     
+    cache_paths = hubspot_cache_paths(emails, name_keys) if BQ_CACHE_DIR else None
+    if cache_paths and all(os.path.exists(path) for path in cache_paths):
+        try:
+            table_modified = client.get_table(HUBSPOT_CONTACTS_TABLE).modified
+            cached_at = min(os.path.getmtime(path) for path in cache_paths)
+            if table_modified and cached_at >= table_modified.timestamp():
+                cached_email_index, cached_name_index = (pd.read_parquet(path) for path in cache_paths)
+                print(f"  ✓ Loaded {len(cached_email_index)} email and {len(cached_name_index)} name "
+                      f"HubSpot contact keys from cache")
+                return cached_email_index, cached_name_index
+        except Exception as e:
+            print(f"  Warning: Ignoring HubSpot contacts cache: {e}")
+    
     query = f"""
     SELECT 
         id as contact_record_id,
         properties_firstname as hs_first_name,
         properties_lastname as hs_last_name,
-        properties_email as hs_email,
-        properties_company as hs_company_name
+        properties_company as hs_company_name,
+        LOWER(TRIM(properties_email)) as email_key,
+        LOWER(TRIM(properties_firstname)) as first_key,
+        LOWER(TRIM(properties_lastname)) as last_key
     FROM `{HUBSPOT_CONTACTS_TABLE}`
-    WHERE properties_email IS NOT NULL 
-       OR (properties_firstname IS NOT NULL AND properties_lastname IS NOT NULL)
+    WHERE LOWER(TRIM(properties_email)) IN UNNEST(@emails)
+       OR CONCAT(LOWER(TRIM(properties_firstname)), '|', LOWER(TRIM(properties_lastname))) IN UNNEST(@name_keys)
     """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter('emails', 'STRING', emails),
+        bigquery.ArrayQueryParameter('name_keys', 'STRING', name_keys),
+    ])
     
     try:
-        print("  Loading HubSpot contacts from BigQuery...")
-        df = client.query(query).to_dataframe()
-        print(f"  ✓ Loaded {len(df)} HubSpot contacts")
-        
-        # Build lookup indexes
-        email_lookup = {}
-        name_lookup = {}
+        print(f"  Loading HubSpot contacts matching {len(emails)} emails or {len(name_keys)} names...")
+        queried_at = time.time()
+        rows = client.query(query, job_config=job_config).result(page_size=CONTACT_BATCH_SIZE)
+        bqstorage_client = bigquery_storage.BigQueryReadClient() if BQSTORAGE_AVAILABLE else None
         
-        for _, row in df.iterrows():
-            email = str(row['hs_email']).lower().strip() if pd.notna(row['hs_email']) else ''
-            first = str(row['hs_first_name']).lower().strip() if pd.notna(row['hs_first_name']) else ''
-            last = str(row['hs_last_name']).lower().strip() if pd.notna(row['hs_last_name']) else ''
-            
-            if email:
-                email_lookup[email] = {
-                    'contact_record_id': row['contact_record_id'],
-                    'hs_first_name': row['hs_first_name'],
-                    'hs_last_name': row['hs_last_name'],
-                    'hs_company_name': row['hs_company_name']
-                }
-            
-            if first and last:
-                name_key = f"{first}|{last}"
-                name_lookup[name_key] = {
-                    'contact_record_id': row['contact_record_id'],
-                    'hs_first_name': row['hs_first_name'],
-                    'hs_last_name': row['hs_last_name'],
-                    'hs_company_name': row['hs_company_name']
-                }
-        
-        return df, email_lookup, name_lookup
+        email_parts, name_parts = [email_index], [name_index]
+        loaded = 0
+        last_progress = time.monotonic()
+        text_dtypes = {column: TEXT_DTYPE for column in HUBSPOT_TEXT_COLUMNS}
+        for batch in rows.to_dataframe_iterable(bqstorage_client=bqstorage_client, dtypes=text_dtypes):
+            batch_email_index, batch_name_index = index_hubspot_contacts(batch)
+            email_parts.append(batch_email_index)
+            name_parts.append(batch_name_index)
+            loaded += len(batch)
+            if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                print(f"  Loaded {loaded} HubSpot contacts...")
+        print(f"  ✓ Loaded {loaded} HubSpot contacts")
+        email_index, name_index = keep_last(pd.concat(email_parts)), keep_last(pd.concat(name_parts))
         
     except Exception as e:
         print(f"  Warning: Error loading HubSpot contacts: {e}")
-        return pd.DataFrame(), {}, {}
+        return email_index, name_index
+    
+    if cache_paths:
+        try:
+            os.makedirs(BQ_CACHE_DIR, exist_ok=True)
+            for index, path in zip((email_index, name_index), cache_paths):
+                index.to_parquet(path)
+                # Stamp with the query time so later table changes invalidate it
+                os.utime(path, (queried_at, queried_at))
+        except Exception as e:
+            print(f"  Warning: Could not cache HubSpot contacts: {e}")
+    return email_index, name_index
 
 
-def check_hubspot_contact_exists(email_lookup: dict, name_lookup: dict, 
-                                  first_name: str, last_name: str, email: str) -> Optional[dict]:
-    """Check if contact exists using in-memory lookups."""
-    # Check by email first (most reliable)
-    if email:
-        email_key = str(email).lower().strip()
-        if email_key in email_lookup:
-            return email_lookup[email_key]
-    
-    # Check by name
-    if first_name and last_name:
-        name_key = f"{str(first_name).lower().strip()}|{str(last_name).lower().strip()}"
-        if name_key in name_lookup:
-            return name_lookup[name_key]
+def replace_sheet(excel_file: str, sheet_name: str, df: pd.DataFrame) -> None:
+    """Write ``df`` as ``sheet_name`` in an existing workbook, replacing that sheet in place.
+
+    Rows are appended straight to the openpyxl worksheet; the workbook is
+    loaded and saved once.
+    """
+    wb = openpyxl.load_workbook(excel_file)
+    position = None
+    if sheet_name in wb.sheetnames:
+        position = wb.sheetnames.index(sheet_name)
+        wb.remove(wb[sheet_name])
+    ws = wb.create_sheet(sheet_name, position)
     
-    return None
+    ws.append([str(column) for column in df.columns])
+    for row in df.astype(object).where(df.notna(), None).itertuples(index=False):
+        ws.append(row)
+    wb.save(excel_file)
 
 
 def main():
@@ -154,79 +253,71 @@ def main():
     # Step 1: Read sheets
     print(f"\n[1/6] Reading Excel sheets...")
     try:
-        contact_df = pd.read_excel(excel_file, sheet_name=contact_sheet)
-        facilities_df = pd.read_excel(excel_file, sheet_name=facilities_sheet)
+        contact_df = pd.read_excel(excel_file, sheet_name=contact_sheet, engine=EXCEL_READ_ENGINE)
+        facilities_df = pd.read_excel(excel_file, sheet_name=facilities_sheet, engine=EXCEL_READ_ENGINE,
+                                      usecols=lambda column: column in FACILITY_COLUMNS)
         print(f"  ✓ Loaded {len(contact_df)} contacts from '{contact_sheet}'")
         print(f"  ✓ Loaded {len(facilities_df)} facilities from '{facilities_sheet}'")
     except Exception as e:
         print(f"  ✗ Error reading Excel: {e}", file=sys.stderr)
         sys.exit(1)
     
-    # Step 2: Create address lookup from Matched Facilities
+    # Step 2: Index Matched Facilities by address (last row wins for repeated addresses)
     print(f"\n[2/6] Building address lookup...")
-    address_lookup = {}
-    for _, row in facilities_df.iterrows():
-        addr = str(row.get('unique_address', '')).strip() if pd.notna(row.get('unique_address')) else ''
-        if addr:
-            address_lookup[addr] = {
-                'hubspot_record_id': row.get('hubspot_record_id', ''),
-                'clickup_task_url': row.get('clickup_task_url', ''),
-                'hubspot_company_name': row.get('hubspot_company_name', '')
-            }
-    print(f"  ✓ Built lookup for {len(address_lookup)} addresses")
+    facility_index = facilities_df.reindex(columns=FACILITY_COLUMNS, fill_value='')
+    facility_index = facility_index.set_index(
+        as_text(facility_index.pop('unique_address')).str.strip().rename('address')
+    )
+    facility_index = facility_index[facility_index.index != '']
+    facility_index = keep_last(facility_index)
+    print(f"  ✓ Built lookup for {len(facility_index)} addresses")
     
-    # Step 3: Load HubSpot contacts for fast lookup
+    # Step 3: Load the HubSpot contacts that share an email or full name with a contact
     print(f"\n[3/6] Loading HubSpot contacts from BigQuery...")
-    _, email_lookup, name_lookup = load_hubspot_contacts()
+    # Normalize matching keys once; they are reused for every lookup and for deduplication
+    contact_text = as_text(contact_df[['name', 'emails', 'address', 'facility']])
+    names = split_names(contact_text['name'])
+    keys = pd.DataFrame({
+        'address': contact_text['address'].str.strip(),
+        'email': contact_text['emails'].str.lower().str.strip(),
+        'first': names['first'].str.lower(),
+        'last': names['last'].str.lower(),
+        'facility': contact_text['facility'].str.lower().str.strip(),
+    })
+    has_name = (keys['first'] != '') & (keys['last'] != '')
+    email_index, name_index = load_hubspot_contacts(
+        sorted(set(keys['email']) - {''}),
+        sorted(set(keys['first'][has_name] + '|' + keys['last'][has_name])),
+    )
     
-    # Step 4: Process each contact
+    # Step 4: Process all contacts column-wise
     print(f"\n[4/6] Processing contacts...")
     
-    # Initialize new columns
-    contact_df['HubSpot Company Association'] = ''
-    contact_df['ClickUp Company Association'] = ''
-    contact_df['First Name'] = ''
-    contact_df['Last Name'] = ''
-    contact_df['HubSpot Contact Record ID'] = ''
-    contact_df['HS Contact First Name'] = ''
-    contact_df['HS Contact Last Name'] = ''
-    contact_df['HS Contact Company'] = ''
+    # Match addresses to facilities
+    facility_matches = keys[['address']].join(facility_index, on='address')
+    address_matched = keys['address'].isin(facility_index.index)
+    matched_count = int(address_matched.sum())
+    contact_df['HubSpot Company Association'] = facility_matches['hubspot_record_id'].where(address_matched, '')
+    contact_df['ClickUp Company Association'] = extract_clickup_task_ids(facility_matches['clickup_task_url'])
     
-    matched_count = 0
-    existing_contacts = 0
+    # Split name into First Name and Last Name
+    contact_df['First Name'] = names['first']
+    contact_df['Last Name'] = names['last']
     
-    for idx, row in contact_df.iterrows():
-        if idx % 100 == 0:
-            print(f"  Processing {idx}/{len(contact_df)}...")
-        
-        # Get address and match to facilities
-        addr = str(row.get('address', '')).strip() if pd.notna(row.get('address')) else ''
-        if addr in address_lookup:
-            matched_count += 1
-            match_data = address_lookup[addr]
-            
-            # Set HubSpot Company Association
-            contact_df.at[idx, 'HubSpot Company Association'] = match_data['hubspot_record_id']
-            
-            # Extract and set ClickUp task ID
-            task_id = extract_clickup_task_id(match_data['clickup_task_url'])
-            contact_df.at[idx, 'ClickUp Company Association'] = task_id
-        
-        # Split name into First Name and Last Name
-        full_name = row.get('name', '')
-        first_name, last_name = split_name(full_name)
-        contact_df.at[idx, 'First Name'] = first_name
-        contact_df.at[idx, 'Last Name'] = last_name
-        
-        # Check if contact exists in HubSpot using in-memory lookup
-        email = str(row.get('emails', '')).strip() if pd.notna(row.get('emails')) else ''
-        hs_contact = check_hubspot_contact_exists(email_lookup, name_lookup, first_name, last_name, email)
-        if hs_contact:
-            existing_contacts += 1
-            contact_df.at[idx, 'HubSpot Contact Record ID'] = hs_contact['contact_record_id']
-            contact_df.at[idx, 'HS Contact First Name'] = hs_contact['hs_first_name']
-            contact_df.at[idx, 'HS Contact Last Name'] = hs_contact['hs_last_name']
-            contact_df.at[idx, 'HS Contact Company'] = hs_contact['hs_company_name']
+    # Check if contact exists in HubSpot, by email first (most reliable), then by name
+    by_email = keys[['email']].join(email_index, on='email')
+    by_name = keys[['first', 'last']].join(name_index, on=['first', 'last'])
+    email_matched = keys['email'].isin(email_index.index)
+    name_matched = pd.MultiIndex.from_frame(keys[['first', 'last']]).isin(name_index.index) & ~email_matched
+    hs_contacts = pd.concat([
+        by_email.loc[email_matched, HUBSPOT_CONTACT_FIELDS],
+        by_name.loc[name_matched, HUBSPOT_CONTACT_FIELDS],
+    ]).reindex(contact_df.index).fillna('')
+    existing_contacts = int((email_matched | name_matched).sum())
+    contact_df['HubSpot Contact Record ID'] = hs_contacts['contact_record_id']
+    contact_df['HS Contact First Name'] = hs_contacts['hs_first_name']
+    contact_df['HS Contact Last Name'] = hs_contacts['hs_last_name']
+    contact_df['HS Contact Company'] = hs_contacts['hs_company_name']
     
     print(f"  ✓ Matched {matched_count} contacts to facilities")
     print(f"  ✓ Found {existing_contacts} existing contacts in HubSpot")
@@ -235,19 +326,12 @@ def main():
     print(f"\n[5/6] Deduplicating contacts...")
     original_count = len(contact_df)
     
-    # Create deduplication key from facility, first name, last name, and emails
-    contact_df['dedup_key'] = (
-        contact_df['facility'].fillna('').str.lower().str.strip() + '|' +
-        contact_df['First Name'].fillna('').str.lower().str.strip() + '|' +
-        contact_df['Last Name'].fillna('').str.lower().str.strip() + '|' +
-        contact_df['emails'].fillna('').str.lower().str.strip()
-    )
+    # Duplicates share normalized facility, first name, last name, and emails;
+    # category columns let the duplicate check hash integer codes
+    dedup_keys = keys[['facility', 'first', 'last', 'email']].astype('category')
     
     # Remove duplicates, keeping the first occurrence
-    contact_df = contact_df.drop_duplicates(subset=['dedup_key'], keep='first')
-    
-    # Remove the temporary dedup key column
-    contact_df = contact_df.drop(columns=['dedup_key'])
+    contact_df = contact_df[~dedup_keys.duplicated(keep='first')]
     
     deduped_count = len(contact_df)
     removed_count = original_count - deduped_count
@@ -256,8 +340,7 @@ def main():
     # Step 6: Save results
     print(f"\n[6/6] Saving results to Excel...")
     try:
-        with pd.ExcelWriter(excel_file, mode='a', engine='openpyxl', if_sheet_exists='replace') as writer:
-            contact_df.to_excel(writer, sheet_name=output_sheet, index=False)
+        replace_sheet(excel_file, output_sheet, contact_df)
         print(f"  ✓ Results saved to '{output_sheet}' sheet in {excel_file}")
     except Exception as e:
         print(f"  ✗ Error saving: {e}", file=sys.stderr)